@@ -26,7 +26,9 @@ if __name__ == '__main__' and not (os.path.exists("./content/data/train.csv") an
 """## Prepare Data for Training"""
 
 # Loading the created dataset using datasets
-from datasets import load_dataset, load_metric, Dataset
+# preprocessed splits are cached here by .map, so point it at fast local storage
+os.environ.setdefault("HF_DATASETS_CACHE", "./content/cache/datasets")
+from datasets import load_dataset, load_metric, Sequence, Value
 
 data_files = {
     "train": "./content/data/train.csv",
@@ -47,6 +49,7 @@ output_column = "emotion"
 # we need to distinguish the unique labels in our SER dataset
 label_list = train_dataset.unique(output_column)
 label_list.sort()  # Let's sort it for determinism
+label2id_map = {label: i for i, label in enumerate(label_list)}
 num_labels = len(label_list)
 print(f"A classification problem with {num_labels} classes: {label_list}")
 
@@ -64,7 +67,7 @@ pooling_mode = "mean"
 config = AutoConfig.from_pretrained(
     model_name_or_path,
     num_labels=num_labels,
-    label2id={label: i for i, label in enumerate(label_list)},
+    label2id=label2id_map,
     id2label={i: label for i, label in enumerate(label_list)},
     finetuning_task="wav2vec2_clf",
 )
@@ -82,101 +85,163 @@ Since the audio file is saved in the `.wav` format, it is easy to use **[Librosa
 
 An audio file usually stores both its values and the sampling rate with which the speech signal was digitalized. We want to store both in the dataset and write a **map(...)** function accordingly. Also, we need to handle the string labels into integers for our specific classification task in this case, the **single-label classification** you may want to use for your **regression** or even **multi-label classification**.
 """
+import functools
+import math
+import julius
+import soundfile as sf
+import torch
 import torchaudio
 import numpy as np
-from tqdm import tqdm
-from datasets import concatenate_datasets
-from nested_array_catcher import nested_array_catcher
+
+gpu_resampling = False # resample on the GPU; CUDA can't be used from forked workers, so preprocessing then runs in one process
+gpu_resample_batch_size = 64 # number of clips resampled together when resampling on the GPU
+max_duration_in_seconds = None # e.g. 16; when set, every clip is padded/truncated to one fixed length
+max_train_duration_in_seconds = None # e.g. 15; when set, longer training clips are dropped
+cache_dtype = np.float16 # dtype the preprocessed input_values are cached in
+
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_sr, target_sr, device="cpu"):
+    # building the sinc kernel is the expensive part, so build it once per (orig_sr, target_sr, device)
+    # zeros=6, rolloff=0.99 match the torchaudio Resample defaults we used before
+    gcd = math.gcd(orig_sr, target_sr)
+    return julius.ResampleFrac(orig_sr // gcd, target_sr // gcd, zeros=6, rolloff=0.99).eval().to(device)
+
+def read_audio(path):
+    # libsndfile is much cheaper per call than torchaudio's backends for plain WAV; keep torchaudio for .mp3 and the rest
+    if path.lower().endswith('.wav'):
+        speech, sampling_rate = sf.read(path, dtype='float32', always_2d=True)
+        return torch.from_numpy(np.ascontiguousarray(speech.T)), sampling_rate # (channels, time), like torchaudio.load
+    return torchaudio.load(path)
 
 def speech_file_to_array_fn(path):
-    speech_array, sampling_rate = torchaudio.load(path)
-    resampler = torchaudio.transforms.Resample(sampling_rate, target_sampling_rate)
-    speech = resampler(speech_array).squeeze().numpy() #  <class 'numpy.ndarray'>
+    speech_array, sampling_rate = read_audio(path)
+    if sampling_rate != target_sampling_rate:
+        resampler = get_resampler(sampling_rate, target_sampling_rate)
+        with torch.no_grad():
+            speech_array = resampler(speech_array)
+    speech = speech_array.squeeze().numpy() #  <class 'numpy.ndarray'>
     return speech
 
-def label_to_id(label, label_list):
-    if len(label_list) > 0:
-        return label_list.index(label) if label in label_list else -1
+def load_speech(path):
+    speech_array, sampling_rate = read_audio(path)
+    return speech_array[0].numpy(), sampling_rate # first channel only, as kept for multi-channel clips
+
+def resample_on_gpu(speech_list, sampling_rates):
+    resampled = list(speech_list)
+    for sampling_rate in set(sampling_rates):
+        if sampling_rate == target_sampling_rate:
+            continue
+        resampler = get_resampler(sampling_rate, target_sampling_rate, "cuda") # kernel built and copied to the GPU once
+        old_sr, new_sr = resampler.old_sr, resampler.new_sr
+        # sorting by length keeps the zero padding inside each batch small
+        indices = sorted((i for i, sr in enumerate(sampling_rates) if sr == sampling_rate), key=lambda i: len(speech_list[i]))
+        for start in range(0, len(indices), gpu_resample_batch_size):
+            batch_indices = indices[start:start + gpu_resample_batch_size]
+            lengths = [len(speech_list[i]) for i in batch_indices]
+            batch = torch.zeros(len(batch_indices), max(lengths))
+            for row, i in enumerate(batch_indices):
+                batch[row, :lengths[row]] = torch.from_numpy(speech_list[i])
+            with torch.no_grad():
+                batch = resampler(batch.to("cuda")).cpu().numpy()
+            for row, i in enumerate(batch_indices):
+                resampled[i] = batch[row, :int(new_sr * lengths[row] / old_sr)] # same output length julius gives unpadded
+    return resampled
+
+def label_to_id(label):
+    if len(label2id_map) > 0:
+        return label2id_map.get(label, -1)
     return label
 
-def preprocess_function(examples):
-    speech_list = [speech_file_to_array_fn(path) for path in examples[input_column]]
-    target_list = [label_to_id(label, label_list) for label in examples[output_column]]
-
-    result = processor(speech_list, sampling_rate=target_sampling_rate) # <class 'transformers.feature_extraction_utils.BatchFeature'> , padding=True??
-    result["labels"] = list(target_list) # list of indicies of of target label
-
-    for i in range(len(result['input_values'])):
-        result['input_values'][i] = nested_array_catcher(result['input_values'][i])
-        # for j in range(len(result['input_values'][i])):
-        #     try:
-        #         assert isinstance(result['input_values'][i][j], np.float32)
-        #     except Exception as e:
-        #         # print(e)
-        #         print(i, j) # 2791 0, 2791 1, 5097 0, 5097 1
-        #         print(294, type(result['input_values'][i]), type(result['input_values'][i][j])) # <class 'numpy.ndarray'> <class 'numpy.ndarray'>
-        #         result['input_values'][i] = result['input_values'][i][j]
-        #         print('new type: ', type(result['input_values'][i][j]), result['input_values'][i][j], result['input_values'][i])
-
-    return result
-
-# train_dataset = train_dataset.map(
-#     preprocess_function,
-#     batch_size=1000, # 9729
-#     batched=True,
-#     num_proc=4 ##
-# )
-# eval_dataset = eval_dataset.map(
-#     preprocess_function,
-#     batch_size=100, #100
-#     batched=True,
-#     num_proc=4
-# )
-#
-# np.save('./features/speech_list_eval_.npy', eval_dataset['input_values'], allow_pickle=True)
-# print(f"eval features saved to ./features/speech_list_eval_.npy")
-# exit() # slurm-36065.out
-
-def ppf(examples, split): # A single process preprocess_function
-    filepath = f'./features/speech_list_{split}.npy'
-    if os.path.exists(filepath):
-        with open(filepath, 'rb') as f:
-            speech_list = np.load(f, allow_pickle=True)
-        print('\nLOADED FEATURES FROM FILE')
-        speech_list = list(speech_list)
+def preprocess_function(examples, feature_extractor):
+    if gpu_resampling:
+        # the GPU is idle during data preparation, so only decode here and resample the whole batch there
+        decoded = [load_speech(path) for path in examples[input_column]]
+        speech_list = resample_on_gpu([speech for speech, _ in decoded], [sr for _, sr in decoded])
     else:
-        print('\nPROCESSING')
-        speech_list = [speech_file_to_array_fn(path) for path in tqdm(examples['path'])]
-        # save to file
-        np.save(filepath, speech_list, allow_pickle=True)
-        print(f"\nFeatures saved to {filepath}")
-    print('speech_list: ', len(speech_list))
-    target_list = [label_to_id(label, label_list) for label in examples['emotion']]
-
-    result = processor(speech_list, sampling_rate=target_sampling_rate) # <class 'transformers.feature_extraction_utils.BatchFeature'> , padding=True??
+        speech_list = [speech_file_to_array_fn(path) for path in examples[input_column]]
+    # multi-channel clips keep their first channel, which is what the nested-array check used to keep
+    speech_list = [speech if speech.ndim == 1 else speech[0] for speech in speech_list]
+    # computed once here and reused for the input_length column (length grouping) and the fixed-length mask
+    input_lengths = np.fromiter((len(speech) for speech in speech_list), dtype=np.int64, count=len(speech_list))
+    target_list = [label_to_id(label) for label in examples[output_column]]
+
+    batch_features = feature_extractor(speech_list, sampling_rate=target_sampling_rate) # <class 'transformers.feature_extraction_utils.BatchFeature'>
+
+    # one cast per item instead of a Python loop over every sample; items that come back nested
+    # (e.g. samples 2791 and 5097 of the train split) keep their first row.
+    # The normalized features are cached in cache_dtype (float16: 2 bytes/sample, like 16-bit PCM) and upcast in
+    # the collator; training autocasts to bf16/fp16 anyway, so float32 storage would buy nothing.
+    input_values = [
+        (x[0] if x.ndim > 1 or x.dtype == object else x).astype(cache_dtype).ravel()
+        for x in batch_features['input_values']
+    ]
+    result = {"input_values": input_values, "input_length": input_lengths}
+    if max_duration_in_seconds is not None:
+        # one dense (N, L) matrix plus its mask instead of a ragged list, so the collator only has to stack rows
+        max_length = int(max_duration_in_seconds * target_sampling_rate)
+        lengths = np.minimum(input_lengths, max_length) # unpadded lengths after truncation
+        dense_input_values = np.zeros((len(input_values), max_length), dtype=cache_dtype)
+        for i, x in enumerate(input_values):
+            dense_input_values[i, :lengths[i]] = x[:lengths[i]]
+        attention_mask = (np.arange(max_length) < lengths[:, None]).astype(np.uint8)
+        result = {"input_values": dense_input_values, "attention_mask": attention_mask, "input_length": lengths}
     result["labels"] = list(target_list) # list of indicies of of target label
 
-    print('\nASSERTING dtype')
-    for i in range(len(result['input_values'])):
-        result['input_values'][i] = nested_array_catcher(result['input_values'][i])
-        # for j in range(len(result['input_values'][i])):
-        #     try:
-        #         assert isinstance(result['input_values'][i][j], np.float32)
-        #     except Exception as e:
-        #         print(i, j) # 2791 0, 2791 1, 5097 0, 5097 1,
-        #         result['input_values'][i] = result['input_values'][i][j]
-
     return result
 
-train_dataset_pp = ppf(train_dataset, 'train')
-train_dataset_pp = Dataset.from_dict(train_dataset_pp)
-eval_dataset_pp = ppf(eval_dataset, 'eval')
-eval_dataset_pp = Dataset.from_dict(eval_dataset_pp)
-
-assert len(train_dataset) == len(train_dataset_pp)
-assert len(eval_dataset) == len(eval_dataset_pp)
-train_dataset = concatenate_datasets([train_dataset, train_dataset_pp],axis=1)
-eval_dataset = concatenate_datasets([eval_dataset, eval_dataset_pp],axis=1)
+def preprocessed_features(examples):
+    if max_duration_in_seconds is None:
+        return None
+    # fixed-length rows are stored as Arrow fixed_size_list columns
+    max_length = int(max_duration_in_seconds * target_sampling_rate)
+    features = examples.features.copy()
+    features["input_values"] = Sequence(Value(np.dtype(cache_dtype).name), length=max_length)
+    features["attention_mask"] = Sequence(Value("uint8"), length=max_length)
+    features["input_length"] = Value("int64")
+    features["labels"] = Value("int64")
+    return features
+
+# .map writes the results as Arrow shards that are memory-mapped back, and caches them by fingerprint,
+# so later runs with the same data and preprocessing skip straight to training.
+# Decoding, resampling (cached julius kernel) and normalization run in 4 worker processes; only GPU resampling,
+# which CUDA doesn't allow from forked workers, keeps everything in this process.
+gpu_resampling = gpu_resampling and torch.cuda.is_available()
+preprocess_num_proc = None if gpu_resampling else 4
+# the workers get the feature extractor loaded above with their shard instead of loading it from disk again;
+# the tokenizer half of the processor is not needed for classification
+preprocess_kwargs = {"feature_extractor": processor.feature_extractor}
+
+train_dataset = train_dataset.map(
+    preprocess_function,
+    batch_size=64,
+    batched=True,
+    num_proc=preprocess_num_proc,
+    writer_batch_size=100,
+    fn_kwargs=preprocess_kwargs,
+    features=preprocessed_features(train_dataset),
+)
+eval_dataset = eval_dataset.map(
+    preprocess_function,
+    batch_size=64,
+    batched=True,
+    num_proc=preprocess_num_proc,
+    writer_batch_size=100,
+    fn_kwargs=preprocess_kwargs,
+    features=preprocessed_features(eval_dataset),
+)
+if max_train_duration_in_seconds is not None:
+    # attention cost grows quadratically with length, so a few very long clips dominate memory and step time;
+    # only the input_length column is read, not the audio
+    max_train_samples = int(max_train_duration_in_seconds * target_sampling_rate)
+    train_dataset = train_dataset.filter(
+        lambda lengths: [length <= max_train_samples for length in lengths],
+        batched=True,
+        input_columns=["input_length"],
+    )
+    print(f"train_dataset after dropping clips longer than {max_train_duration_in_seconds}s: {len(train_dataset)}")
+if max_duration_in_seconds is not None:
+    train_dataset.set_format("numpy", columns=["input_values", "attention_mask"], output_all_columns=True)
+    eval_dataset.set_format("numpy", columns=["input_values", "attention_mask"], output_all_columns=True)
 
 print(train_dataset.features.type) # <class 'datasets.arrow_dataset.Dataset'> ### but we have <class 'transformers.feature_extraction_utils.BatchFeature'>
 print(train_dataset)
@@ -216,6 +281,15 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
 )
 
 
+def masked_mean(hidden_states, attention_mask):
+    # average over the real frames only, padded frames would pull the mean towards them
+    mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+    return (hidden_states * mask).sum(1) / mask.sum(1).clamp(min=1)
+
+if hasattr(torch, "compile"):
+    masked_mean = torch.compile(masked_mean) # fuses the multiply into the reductions
+
+
 class Wav2Vec2ClassificationHead(nn.Module):
     """Head for wav2vec classification task."""
 
@@ -253,10 +327,14 @@ class Wav2Vec2ForSpeechClassification(Wav2Vec2PreTrainedModel):
     def merged_strategy(
             self,
             hidden_states,
-            mode="mean"
+            mode="mean",
+            attention_mask=None
     ):
         if mode == "mean":
-            outputs = torch.mean(hidden_states, dim=1)
+            if attention_mask is None:
+                outputs = torch.mean(hidden_states, dim=1)
+            else:
+                outputs = masked_mean(hidden_states, attention_mask)
         elif mode == "sum":
             outputs = torch.sum(hidden_states, dim=1)
         elif mode == "max":
@@ -285,7 +363,10 @@ class Wav2Vec2ForSpeechClassification(Wav2Vec2PreTrainedModel):
             return_dict=return_dict,
         )
         hidden_states = outputs[0]
-        hidden_states = self.merged_strategy(hidden_states, mode=self.pooling_mode)
+        if attention_mask is not None:
+            # downsample the sample-level mask to the frame rate of hidden_states
+            attention_mask = self.wav2vec2._get_feature_vector_attention_mask(hidden_states.shape[1], attention_mask)
+        hidden_states = self.merged_strategy(hidden_states, mode=self.pooling_mode, attention_mask=attention_mask)
         logits = self.classifier(hidden_states)
 
         loss = None
@@ -341,7 +422,7 @@ Without going into too many details, in contrast to the common data collators, t
 Analogous to the common data collators, the padding tokens in the labels with `-100` so that those tokens are **not** taken into account when computing the loss.
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Union
 import torch
 
@@ -373,6 +454,8 @@ class DataCollatorCTCWithPadding:
             If set will pad the sequence to a multiple of the provided value.
             This is especially useful to enable the use of Tensor Cores on NVIDIA hardware with compute capability >=
             7.5 (Volta).
+        is_regression (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether the labels are regression targets (float) rather than class indices (long).
     """
 
     processor: Wav2Vec2Processor
@@ -381,30 +464,43 @@ class DataCollatorCTCWithPadding:
     max_length_labels: Optional[int] = None
     pad_to_multiple_of: Optional[int] = None
     pad_to_multiple_of_labels: Optional[int] = None
+    is_regression: bool = False
+    _label_dtype: torch.dtype = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # the label dtype is fixed by the task, so decide it once instead of on every batch
+        self._label_dtype = torch.float if self.is_regression else torch.long
 
     def __call__(self, features: List[Dict[str, Union[List[int], torch.Tensor]]]) -> Dict[str, torch.Tensor]:
-        input_features = [{"input_values": feature["input_values"]} for feature in features]
         label_features = [feature["labels"] for feature in features]
 
-        d_type = torch.long if isinstance(label_features[0], int) else torch.float
-
-        batch = self.processor.pad(
-            input_features,
-            padding=self.padding,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors="pt",
-        )
-
-        batch["labels"] = torch.tensor(label_features, dtype=d_type)
+        if "attention_mask" in features[0]:
+            # rows were already padded to one fixed length in preprocess_function
+            batch = {
+                "input_values": torch.from_numpy(np.stack([feature["input_values"] for feature in features])).float(),
+                "attention_mask": torch.from_numpy(np.stack([feature["attention_mask"] for feature in features])).long(),
+            }
+        else:
+            input_features = [{"input_values": feature["input_values"]} for feature in features]
+            batch = self.processor.pad(
+                input_features,
+                padding=self.padding,
+                max_length=self.max_length,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors="pt",
+            )
+            # the cached rows come back as float16 and pad() only upcasts float64
+            batch["input_values"] = batch["input_values"].float()
+
+        batch["labels"] = torch.as_tensor(label_features, dtype=self._label_dtype)
 
         return batch
 
-data_collator = DataCollatorCTCWithPadding(processor=processor, padding=True)
+is_regression = False
 
-"""Next, the evaluation metric is defined. There are many pre-defined metrics for classification/regression problems, but in this case, we would continue with just **Accuracy** for classification and **MSE** for regression. You can define other metrics on your own."""
+data_collator = DataCollatorCTCWithPadding(processor=processor, padding=True, is_regression=is_regression)
 
-is_regression = False
+"""Next, the evaluation metric is defined. There are many pre-defined metrics for classification/regression problems, but in this case, we would continue with just **Accuracy** for classification and **MSE** for regression. You can define other metrics on your own."""
 
 import numpy as np
 from transformers import EvalPrediction
@@ -415,9 +511,9 @@ def compute_metrics(p: EvalPrediction):
     preds = np.squeeze(preds) if is_regression else np.argmax(preds, axis=1)
 
     if is_regression:
-        return {"mse": ((preds - p.label_ids) ** 2).mean().item()}
+        return {"mse": float(np.mean(np.square(preds - p.label_ids, dtype=np.float64)))}
     else:
-        return {"accuracy": (preds == p.label_ids).astype(np.float32).mean().item()}
+        return {"accuracy": float(np.count_nonzero(preds == p.label_ids)) / preds.size}
 
 """Now, we can load the pretrained XLSR-Wav2Vec2 checkpoint into our classification model with a pooling strategy."""
 
@@ -432,6 +528,14 @@ Thus, we can set the `requires_grad` to `False` for all parameters of the *featu
 
 model.freeze_feature_extractor()
 
+# trade recomputation for activation memory, and compile the backbone's and the head's forward in place
+# (wrapping the module itself would change the checkpoint keys that from_pretrained expects);
+# in the head the dropout/tanh elementwise ops fuse into the linear layers instead of each launching a kernel
+model.gradient_checkpointing_enable()
+if hasattr(torch, "compile"):
+    model.wav2vec2.forward = torch.compile(model.wav2vec2.forward)
+    model.classifier.forward = torch.compile(model.classifier.forward)
+
 """In a final step, we define all parameters related to training.
 To give more explanation on some of the parameters:
 - `learning_rate` and `weight_decay` were heuristically tuned until fine-tuning has become stable. Note that those parameters strongly depend on the Common Voice dataset and might be suboptimal for other speech datasets.
@@ -445,8 +549,12 @@ For more explanations on other parameters, one can take a look at the [docs](htt
 
 # drive.mount('/gdrive')
 
+import multiprocessing
 from transformers import TrainingArguments
 
+# bf16 has the range of fp32, so it needs no loss scaling; fall back to fp16 on older GPUs
+use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
 training_args = TrainingArguments(
     output_dir="./content/wav2vec2-xlsr-greek-speech-emotion-recognition",
     # output_dir="/content/gdrive/MyDrive/wav2vec2-xlsr-greek-speech-emotion-recognition"
@@ -455,12 +563,19 @@ training_args = TrainingArguments(
     gradient_accumulation_steps=2,
     evaluation_strategy="steps",
     num_train_epochs=1.0,
-    fp16=True,
+    fp16=not use_bf16,
+    bf16=use_bf16,
     save_steps=10,
     eval_steps=10,
     logging_steps=10,
     learning_rate=1e-4,
     save_total_limit=2,
+    group_by_length=True, # batch clips of similar length together to cut padding
+    length_column_name="input_length",
+    # collate in worker processes into pinned buffers so host-to-device copies overlap with compute;
+    # only with fork: under spawn every worker would re-run this whole (unguarded) script
+    dataloader_pin_memory=True,
+    dataloader_num_workers=max(1, (os.cpu_count() or 2) // 2) if multiprocessing.get_start_method() == "fork" else 0,
 )
 
 """For future use we can create our training script, we do it in a simple way. You can add more on you own."""
@@ -508,7 +623,7 @@ class CTCTrainer(Trainer):
         inputs = self._prepare_inputs(inputs)
 
         if self.use_amp:
-            with autocast():
+            with autocast(dtype=torch.bfloat16 if self.args.bf16 else torch.float16):
                 loss = self.compute_loss(model, inputs)
         else:
             loss = self.compute_loss(model, inputs)
@@ -516,7 +631,8 @@ class CTCTrainer(Trainer):
         if self.args.gradient_accumulation_steps > 1:
             loss = loss / self.args.gradient_accumulation_steps
 
-        if self.use_amp:
+        # scale whenever the base Trainer will unscale/step through its GradScaler (it may do so under bf16 too)
+        if getattr(self, "do_grad_scaling", self.use_amp):
             self.scaler.scale(loss).backward()
         elif self.use_apex:
             with amp.scale_loss(loss, self.optimizer) as scaled_loss:
@@ -66,10 +66,16 @@ class Wav2Vec2ForSpeechClassification(Wav2Vec2PreTrainedModel):
     def merged_strategy(
             self,
             hidden_states,
-            mode="mean"
+            mode="mean",
+            attention_mask=None
     ):
         if mode == "mean":
-            outputs = torch.mean(hidden_states, dim=1)
+            if attention_mask is None:
+                outputs = torch.mean(hidden_states, dim=1)
+            else:
+                # average over the real frames only, padded frames would pull the mean towards them
+                mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+                outputs = (hidden_states * mask).sum(1) / mask.sum(1).clamp(min=1)
         elif mode == "sum":
             outputs = torch.sum(hidden_states, dim=1)
         elif mode == "max":
@@ -98,7 +104,10 @@ class Wav2Vec2ForSpeechClassification(Wav2Vec2PreTrainedModel):
             return_dict=return_dict,
         )
         hidden_states = outputs[0]
-        hidden_states = self.merged_strategy(hidden_states, mode=self.pooling_mode)
+        if attention_mask is not None:
+            # downsample the sample-level mask to the frame rate of hidden_states
+            attention_mask = self.wav2vec2._get_feature_vector_attention_mask(hidden_states.shape[1], attention_mask)
+        hidden_states = self.merged_strategy(hidden_states, mode=self.pooling_mode, attention_mask=attention_mask)
         logits = self.classifier(hidden_states)
 
         loss = None
@@ -1,23 +1,29 @@
 """# Prediction"""
 
+import functools
+import hashlib
+import os
+import queue
+import tempfile
+from dataclasses import dataclass
+
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 import torchaudio
+from torch.utils.data import DataLoader, Dataset
 from transformers import AutoConfig, Wav2Vec2Processor
 
-import librosa
 import IPython.display as ipd
 import numpy as np
 import pandas as pd
+import soundfile as sf
 
-from nested_array_catcher import nested_array_catcher
 from transformers.models.wav2vec2.modeling_wav2vec2 import (
     Wav2Vec2PreTrainedModel,
     Wav2Vec2Model
 )
 # from cpu_emotion_recognition_in_greek_speech_using_wav2vec2.py import Wav2Vec2ForSpeechClassification
-from typing import Optional, Tuple
+from typing import Any, Optional, Tuple
 from transformers.file_utils import ModelOutput
 
 class SpeechClassifierOutput(ModelOutput):
@@ -62,10 +68,17 @@ class Wav2Vec2ForSpeechClassification(Wav2Vec2PreTrainedModel):
     def merged_strategy(
             self,
             hidden_states,
-            mode="mean"
+            mode="mean",
+            attention_mask=None
     ):
         if mode == "mean":
-            outputs = torch.mean(hidden_states, dim=1)
+            if attention_mask is None:
+                outputs = torch.mean(hidden_states, dim=1)
+            else:
+                # average over the real frames only, padded frames would pull the mean towards them;
+                # summed in fp32, bf16 can't count frames past 256 exactly
+                mask = attention_mask.unsqueeze(-1).float()
+                outputs = ((hidden_states.float() * mask).sum(1) / mask.sum(1).clamp(min=1)).to(hidden_states.dtype)
         elif mode == "sum":
             outputs = torch.sum(hidden_states, dim=1)
         elif mode == "max":
@@ -94,7 +107,10 @@ class Wav2Vec2ForSpeechClassification(Wav2Vec2PreTrainedModel):
             return_dict=return_dict,
         )
         hidden_states = outputs[0]
-        hidden_states = self.merged_strategy(hidden_states, mode=self.pooling_mode)
+        if attention_mask is not None:
+            # downsample the sample-level mask to the frame rate of hidden_states
+            attention_mask = self.wav2vec2._get_feature_vector_attention_mask(hidden_states.shape[1], attention_mask)
+        hidden_states = self.merged_strategy(hidden_states, mode=self.pooling_mode, attention_mask=attention_mask)
         logits = self.classifier(hidden_states)
 
         loss = None
@@ -134,31 +150,270 @@ model_name_or_path = "./content/wav2vec2-xlsr-greek-speech-emotion-recognition/c
 config = AutoConfig.from_pretrained(model_name_or_path)
 processor = Wav2Vec2Processor.from_pretrained(processor_name_or_path) ##
 sampling_rate = processor.feature_extractor.sampling_rate
-model = Wav2Vec2ForSpeechClassification.from_pretrained(model_name_or_path).to(device)
+LABELS = tuple(config.id2label[i] for i in range(config.num_labels)) # class index -> name, converted once at load
+BUCKETS = (3 * sampling_rate, 6 * sampling_rate) # fixed padded lengths (3 s / 6 s), see next_bucket
+chunk_length, chunk_hop = 6 * sampling_rate, 5 * sampling_rate # longer clips: 6 s windows overlapping by 1 s, see split_clip
+use_onnx = False # run the forward with ONNX Runtime (needs the onnxruntime / onnxruntime-gpu package)
+onnx_path = "./content/wav2vec2-xlsr-greek-speech-emotion-recognition.onnx"
+quantize_on_cpu = True # dynamic int8 quantization when running on CPU without ONNX Runtime
+
+
+@dataclass
+class InferenceModel:
+    """What predict_batch runs: the torch model or an ONNX Runtime session, plus how to feed it."""
+    model: Optional[nn.Module] = None
+    ort_session: Any = None
+    dtype: torch.dtype = torch.float32
+    use_buckets: bool = False # pad to the fixed BUCKETS; only pays off for the compiled model, elsewhere it's wasted compute
+    copy_stream: Any = None # D2H copies run here, beside the next forward
+
+
+def load_model():
+    # called from the main process only: loader workers re-import this file under spawn and must not load the model again
+    model = Wav2Vec2ForSpeechClassification.from_pretrained(model_name_or_path).to(device).eval() # inference only
+    runner = InferenceModel(copy_stream=torch.cuda.Stream() if device.type == "cuda" else None)
+
+    if use_onnx:
+        import onnxruntime as ort
+
+        if not os.path.exists(onnx_path):
+            # exported once from the fp32 model; batch and time axes stay dynamic
+            dummy_input_values = torch.zeros(1, sampling_rate, device=device)
+            dummy_attention_mask = torch.ones(1, sampling_rate, dtype=torch.long, device=device)
+            torch.onnx.export(
+                model,
+                (dummy_input_values, dummy_attention_mask, None, None, False), # return_dict=False -> (logits,)
+                onnx_path,
+                input_names=["input_values", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={"input_values": {0: "batch", 1: "time"}, "attention_mask": {0: "batch", 1: "time"}},
+                opset_version=17,
+            )
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in ort.get_available_providers()]
+        runner.ort_session = ort.InferenceSession(onnx_path, providers=providers)
+        return runner
+
+    if device.type == "cuda":
+        # on GPU: half-width weights/activations (bf16 where supported) and a compiled, CUDA-graph friendly forward
+        runner.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        model = model.to(dtype=runner.dtype)
+        if hasattr(torch, "compile"):
+            model = torch.compile(model, mode="max-autotune")
+            runner.use_buckets = True
+            # compile each bucket ahead of time; real batches of another size may still trigger a recompile
+            with torch.inference_mode():
+                for bucket in BUCKETS:
+                    model(torch.zeros(1, bucket, dtype=runner.dtype, device=device),
+                          attention_mask=torch.ones(1, bucket, dtype=torch.long, device=device))
+    elif quantize_on_cpu:
+        # on CPU: int8 weights for the Linear layers (transformer + head), run by the int8 GEMM kernels;
+        # the conv feature encoder isn't covered by dynamic quantization and stays fp32
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    runner.model = model
+    return runner
+
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_sr, new_sr):
+    # the filter kernel is built once per (orig_sr, new_sr) pair in each loader worker
+    return torchaudio.transforms.Resample(orig_freq=orig_sr, new_freq=new_sr)
+
+def resample(speech, orig_sr, new_sr):
+    if orig_sr == new_sr:
+        return speech
+    return get_resampler(orig_sr, new_sr)(speech)
 
 def speech_file_to_array_fn(path, sampling_rate):
-    speech_array, _sampling_rate = torchaudio.load(path)
-    resampler = torchaudio.transforms.Resample(_sampling_rate)
-    speech = resampler(speech_array).squeeze().numpy()
-
-    speech = nested_array_catcher(speech)
-
-    return speech
-
-
-def predict(path, sampling_rate):
-    speech = speech_file_to_array_fn(path, sampling_rate)
-    features = processor(speech, sampling_rate=sampling_rate, return_tensors="pt", padding=True)
-
-    input_values = features.input_values.to(device)
-    attention_mask = features.attention_mask.to(device)
-
-    with torch.no_grad():
-        logits = model(input_values, attention_mask=attention_mask).logits
-
-    scores = F.softmax(logits, dim=1).detach().cpu().numpy()[0]
-    outputs = [{"Emotion": config.id2label[i], "Score": f"{round(score * 100, 3):.1f}%"} for i, score in enumerate(scores)]
-    return outputs
+    # multi-channel files keep their first channel, as nested_array_catcher did and the training script does
+    if path.lower().endswith(".wav"):
+        # soundfile hands back the numpy array directly and is much lighter than torchaudio's backends for WAV
+        speech, _sampling_rate = sf.read(path, dtype="float32", always_2d=True)
+        wave = torch.from_numpy(np.ascontiguousarray(speech[:, 0]))
+    else:
+        speech_array, _sampling_rate = torchaudio.load(path)
+        wave = speech_array[0].contiguous()
+    # stays a 1-D tensor through the resampler; .numpy() at the end shares its memory, no copy
+    return resample(wave, _sampling_rate, sampling_rate).numpy()
+
+
+cache_dir = "./content/cache/prediction" # test audio already resampled to sampling_rate, see precompute_cache
+
+def cache_path(path, out_dir=cache_dir):
+    # mtime and size are part of the key, so a file replaced at the same path isn't served stale
+    stat = os.stat(path)
+    key = f"{path}:{stat.st_mtime_ns}:{stat.st_size}"
+    return os.path.join(out_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.{sampling_rate}.f16.npy")
+
+def precompute_cache(test_df, out_dir=cache_dir):
+    # one pass over the test set; later runs read the cached clips instead of decoding and resampling again
+    os.makedirs(out_dir, exist_ok=True)
+    for path in test_df["path"]:
+        cached = cache_path(path, out_dir)
+        if not os.path.exists(cached):
+            # written to a temporary file and renamed, so an interrupted run never leaves a truncated .npy behind
+            with tempfile.NamedTemporaryFile(dir=out_dir, suffix=".npy", delete=False) as tmp:
+                np.save(tmp, speech_file_to_array_fn(path, sampling_rate).astype(np.float16)) # fp16 halves the cache
+            os.replace(tmp.name, cached)
+
+class F32Pool:
+    """Reusable float32 buffers of one canonical length, so loading cached clips doesn't allocate per clip."""
+
+    def __init__(self, length, size=64):
+        self.length = length
+        self._buffers = queue.LifoQueue(maxsize=size)
+        self._lent = set()
+
+    def get(self, n):
+        if n > self.length:
+            return np.empty(n, dtype=np.float32) # longer than the canonical length: not pooled
+        try:
+            buf = self._buffers.get_nowait()
+        except queue.Empty:
+            buf = np.empty(self.length, dtype=np.float32)
+        self._lent.add(id(buf))
+        return buf[:n]
+
+    def put(self, arr):
+        buf = arr.base
+        if buf is None or id(buf) not in self._lent:
+            return # not one of ours
+        self._lent.discard(id(buf))
+        try:
+            self._buffers.put_nowait(buf)
+        except queue.Full:
+            pass
+
+POOL = F32Pool(6 * sampling_rate) # one per process, i.e. per loader worker
+
+def load_speech(path, pool=None):
+    cached = cache_path(path)
+    if os.path.exists(cached):
+        cached_speech = np.load(cached, mmap_mode="r")
+        if pool is None:
+            return cached_speech.astype(np.float32)
+        speech = pool.get(len(cached_speech))
+        np.copyto(speech, cached_speech) # fp16 -> fp32 straight into a pooled buffer
+        return speech
+    return speech_file_to_array_fn(path, sampling_rate)
+
+
+class EmotionDataset(Dataset):
+    """Audio files of a test DataFrame, read from the resampled cache or loaded and resampled on access."""
+
+    def __init__(self, df):
+        self.paths = list(df["path"])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return load_speech(self.paths[idx], pool=POOL)
+
+
+def next_bucket(length):
+    for bucket in BUCKETS:
+        if length <= bucket:
+            return bucket
+    raise AssertionError(f"chunk of {length} samples is longer than the largest bucket, split_clip should have split it")
+
+
+def split_clip(speech):
+    if len(speech) <= chunk_length:
+        return [speech]
+    # views into the clip, no copy; one more window aligned to the end covers a tail the hop doesn't reach
+    chunks = list(torch.from_numpy(speech).unfold(0, chunk_length, chunk_hop).numpy())
+    if (len(speech) - chunk_length) % chunk_hop:
+        chunks.append(speech[-chunk_length:])
+    return chunks
+
+
+def pad_collate(speech_list, use_buckets=False):
+    # long clips become several 6 s chunks in the batch; clip_ids maps every row back to its clip
+    chunks, clip_ids = [], []
+    for clip_id, speech in enumerate(speech_list):
+        clip_chunks = split_clip(speech)
+        chunks.extend(clip_chunks)
+        clip_ids.extend([clip_id] * len(clip_chunks))
+    # the processor normalizes every chunk and pads the batch (a plain pad_sequence would skip the normalization);
+    # for the compiled model T is padded up to one of a few fixed buckets so its graph is reused instead of
+    # recompiled per length, otherwise just to the longest chunk; the attention mask keeps the padding out of the pooled features
+    if use_buckets:
+        max_length = next_bucket(max(len(chunk) for chunk in chunks))
+        features = processor(chunks, sampling_rate=sampling_rate, return_tensors="pt", padding="max_length", max_length=max_length)
+    else:
+        features = processor(chunks, sampling_rate=sampling_rate, return_tensors="pt", padding=True)
+    # the processor has copied the clips into the batch, so their buffers can serve the next batch
+    for speech in speech_list:
+        POOL.put(speech)
+    return features.input_values, features.attention_mask, torch.tensor(clip_ids)
+
+
+def init_loader_worker(worker_id):
+    torch.set_num_threads(1) # the workers are the parallelism, don't let each of them spread over every core
+
+
+verbose = False # True: keep every class score per clip; False: only the top_k classes leave the GPU
+top_k = 1
+
+
+def predict_batch(runner, input_values, attention_mask, clip_ids):
+    """Launches the forward for one batch; returns (scores, indices, ready_event) for collect_predictions."""
+    n_clips = int(clip_ids[-1]) + 1
+    if runner.ort_session is not None:
+        logits = torch.from_numpy(runner.ort_session.run(["logits"], {
+            "input_values": input_values.numpy(),
+            "attention_mask": attention_mask.numpy().astype(np.int64),
+        })[0])
+    else:
+        input_values = input_values.to(device, dtype=runner.dtype, non_blocking=True)
+        attention_mask = attention_mask.to(device, non_blocking=True)
+
+        with torch.inference_mode():
+            logits = runner.model(input_values, attention_mask=attention_mask).logits
+
+    with torch.inference_mode():
+        logits = logits.float()
+        if len(clip_ids) != n_clips:
+            # average the logits of each clip's chunks
+            clip_ids = clip_ids.to(logits.device, non_blocking=True)
+            summed = logits.new_zeros(n_clips, logits.shape[-1]).index_add_(0, clip_ids, logits)
+            logits = summed / torch.bincount(clip_ids, minlength=n_clips).unsqueeze(-1)
+
+        # softmax and top-k where the logits are, so only (B, k) has to be copied to the host
+        scores = torch.softmax(logits, dim=-1)
+        indices = None
+        if not verbose:
+            scores, indices = scores.topk(min(top_k, scores.shape[-1]), dim=-1)
+
+        copy_stream = runner.copy_stream
+        if copy_stream is None or not scores.is_cuda:
+            return scores, indices, None
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            for t in (scores, indices):
+                if t is not None:
+                    t.record_stream(copy_stream) # keep the device memory alive until the copy is done
+            scores = scores.to("cpu", non_blocking=True)
+            indices = indices.to("cpu", non_blocking=True) if indices is not None else None
+            ready = torch.cuda.Event()
+            ready.record(copy_stream)
+    return scores, indices, ready
+
+
+def collect_predictions(scores, indices, ready):
+    if ready is not None:
+        ready.synchronize()
+    scores = scores.numpy()
+    # percentages for the whole (B, k) matrix at once, formatted in one vectorized pass
+    pct = np.char.mod("%.1f%%", (scores * 100).round(1))
+    if indices is None:
+        return [
+            [{"Emotion": label, "Score": score} for label, score in zip(LABELS, row_pct)]
+            for row_pct in pct
+        ]
+    return [
+        [{"Emotion": LABELS[i], "Score": score} for i, score in zip(row_indices, row_pct)]
+        for row_indices, row_pct in zip(indices.numpy().tolist(), pct)
+    ]
 
 
 STYLES = """
@@ -179,31 +434,56 @@ table.xxx td {
 </style>
 """.strip()
 
-def prediction(df_row):
-    path, emotion = df_row["path"], df_row["emotion"]
+TABLE_SETUP = {
+    'border': 2,
+    'show_dimensions': True,
+    'justify': 'center',
+    'classes': 'xxx',
+    'escape': False,
+}
+
+def display_prediction(outputs, emotion, speech=None):
+    # notebook rendering only, kept out of prediction() so batch inference doesn't build DataFrames/HTML
     df = pd.DataFrame([{"Emotion": emotion, "Sentence": "    "}])
-    setup = {
-        'border': 2,
-        'show_dimensions': True,
-        'justify': 'center',
-        'classes': 'xxx',
-        'escape': False,
-    }
-    ipd.display(ipd.HTML(STYLES + df.to_html(**setup) + "<br />")) ##
-    speech, sr = torchaudio.load(path)
-    speech = speech[0].numpy().squeeze()
-    speech = librosa.resample(np.asarray(speech), sr, sampling_rate)
-    ipd.display(ipd.Audio(data=np.asarray(speech), autoplay=True, rate=sampling_rate)) ##
-
-    outputs = predict(path, sampling_rate)
-    r = pd.DataFrame(outputs)
-    ipd.display(ipd.HTML(STYLES + r.to_html(**setup) + "<br />")) ##
+    ipd.display(ipd.HTML(STYLES + df.to_html(**TABLE_SETUP) + "<br />")) ##
+    if speech is not None:
+        ipd.display(ipd.Audio(data=speech, autoplay=True, rate=sampling_rate)) ##
 
-test = pd.read_csv("./content/data/test.csv", sep="\t")
-test.head()
+    r = pd.DataFrame(outputs)
+    ipd.display(ipd.HTML(STYLES + r.to_html(**TABLE_SETUP) + "<br />")) ##
+
+def prediction(df_rows, runner, batch_size=8):
+    # worker processes load and resample the next batches while the model, loaded once in this process, runs on the current one
+    dataset = EmotionDataset(df_rows)
+    n_batches = -(-len(dataset) // batch_size)
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=max(1, min((os.cpu_count() or 2) // 2, n_batches)), # no more workers than there are batches to load
+        prefetch_factor=4,
+        pin_memory=device.type == "cuda",
+        collate_fn=functools.partial(pad_collate, use_buckets=runner.use_buckets),
+        worker_init_fn=init_loader_worker,
+    )
+    outputs = []
+    pending = None
+    for input_values, attention_mask, clip_ids in loader:
+        # the previous batch's results are copied back while this batch's forward is queued on the GPU
+        launched = predict_batch(runner, input_values, attention_mask, clip_ids)
+        if pending is not None:
+            outputs.extend(collect_predictions(*pending))
+        pending = launched
+    if pending is not None:
+        outputs.extend(collect_predictions(*pending))
+    return outputs
 
-prediction(test.iloc[0])
+if __name__ == "__main__": # loader workers re-import this file under the spawn start method
+    runner = load_model()
 
-prediction(test.iloc[1])
+    test = pd.read_csv("./content/data/test.csv", sep="\t")
+    test.head()
 
-prediction(test.iloc[2])
+    rows = test.iloc[0:3]
+    precompute_cache(rows)
+    for row, outputs in zip(rows.itertuples(), prediction(rows, runner)):
+        display_prediction(outputs, row.emotion, load_speech(row.path))